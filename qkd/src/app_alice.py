@@ -1,9 +1,15 @@
+import base64
 import json
 import math
+import os
 import random
+import secrets
+import sys
 from dataclasses import dataclass
 from typing import Optional
 
+import numpy as np
+
 from netqasm.logging.glob import get_netqasm_logger
 #from netqasm.sdk import EPRSocket
 
@@ -15,19 +21,39 @@ from netqasm.sdk.external import NetQASMConnection, Socket
 
 logger = get_netqasm_logger()
 
-buf_msgs = []  # type: ignore
+# Received bytes not yet returned as a message, may end in a partial frame
+buf_recv = bytearray()
 EOF = "EOF"
+# Table name of each basis, indexed by basis (0 = Z, 1 = X)
+BASIS_NAMES = ("Z", "X")
+# Tables from h_table, keyed by the number of compared outcomes
+h_tables = {}  # type: ignore
 ALL_MEASURED = "All qubits measured"
+# Bob's bases only arrive once he has measured, so the explicit ALL_MEASURED
+# round-trip is only made for debugging. Must be set the same for Bob.
+DEBUG_HANDSHAKE = bool(os.environ.get("DEBUG_HANDSHAKE"))
+# Assured messages sent before blocking on an ACK from Bob, 1 is a strict fence
+ACK_WINDOW = 32
+# Sequence number of the next assured message, and highest seq Bob acknowledged
+send_seq = 0
+acked_seq = -1
+# Number of EPR pairs requested per round-trip, must match Bob. Each pair
+# holds a live qubit until measured, so this is bounded by the 3 qubits per node
+# in the shipped networks (exp/input/network.yaml)
+BATCH_SIZE = 3
 
 
 def recv_single_msg(socket):
     """Used to not get multiple messages at a time"""
-    if len(buf_msgs) > 0:
-        msg = buf_msgs.pop(0)
-    else:
-        msgs = socket.recv().split(EOF)[:-1]
-        buf_msgs.extend(msgs[1:])
-        msg = msgs[0]
+    delim = EOF.encode()
+    idx = buf_recv.find(delim)
+    while idx < 0:
+        # Keep scanning only the newly received bytes (plus a possible split delimiter)
+        start = max(len(buf_recv) - len(delim) + 1, 0)
+        buf_recv.extend(socket.recv().encode())
+        idx = buf_recv.find(delim, start)
+    msg = buf_recv[:idx].decode()
+    del buf_recv[:idx + len(delim)]
     logger.debug(f"Alice received msg {msg}")
     return msg
 
@@ -37,89 +63,129 @@ def send_single_msg(socket, msg):
     socket.send(msg + EOF)
 
 
-def sendClassicalAssured(socket, data):
-    data = json.dumps(data)
+def sendClassicalAssured(socket, data, window=ACK_WINDOW):
+    global send_seq, acked_seq
+    # Only ask for an ACK once the window of unacknowledged messages is full
+    need_ack = send_seq - acked_seq >= window
+    data = json.dumps({"seq": send_seq, "ack": need_ack, "data": data})
     send_single_msg(socket, data)
-    while recv_single_msg(socket) != "ACK":
-        pass
+    send_seq += 1
+    while need_ack and acked_seq < send_seq - 1:
+        msg = recv_single_msg(socket)
+        if msg.startswith("ACK "):
+            acked_seq = int(msg[len("ACK "):])
 
 
 def recvClassicalAssured(socket):
-    data = recv_single_msg(socket)
-    data = json.loads(data)
-    send_single_msg(socket, "ACK")
-    return data
+    msg = json.loads(recv_single_msg(socket))
+    # Messages arrive in order, so this acknowledges everything up to seq
+    if msg["ack"]:
+        send_single_msg(socket, f"ACK {msg['seq']}")
+    return msg["data"]
 
 
-def distribute_bb92_states(conn, epr_socket, socket, target, n):
-    # Empty list of length n
-    bit_flips = [None for _ in range(n)]
+def distribute_bb92_states(conn, epr_socket, socket, target, n, batch_size=BATCH_SIZE):
+    # Empty buffer of length n
+    bit_flips = np.empty(n, dtype=np.uint8)
 
-    # List of zeros/ones of length n
-    basis_flips = [random.randint(0, 1) for _ in range(n)]
+    # Zeros/ones of length n, from a cryptographically secure source
+    basis_flips = np.unpackbits(
+        np.frombuffer(secrets.token_bytes((n + 7) // 8), dtype=np.uint8)
+    )[:n]
 
-    # Share EPR pairs
-    for i in range(n):
+    # Share EPR pairs, batch_size at a time (Bob must use the same batch_size)
+    for start in range(0, n, batch_size):
         # (Alice blocks here, until Socket established with Bob)
-        q = epr_socket.create_keep(1)[0]
+        qs = epr_socket.create_keep(min(batch_size, n - start))
 
         # Based on pre-determine bases, Alice performs basis change
-        if basis_flips[i]:
-            q.H()
+        for j, q in enumerate(qs):
+            if basis_flips[start + j]:
+                q.H()
 
-        # Ensure that bob has access to the pair, before we measure
+        # Ensure that bob has access to the pairs, before we measure
         # IMPORTANT: this is the key distinction between BB84, BB92
         # The quantum processor must actually have shared the pair
         # prior to Alice's measurement, otherwise she will have implicitly
         # prepared a specific state by measuring it prior to Bob's access.
         conn.flush()
 
-        # Records the measurement
-        m = q.measure()
+        # Records the measurements
+        ms = [q.measure() for q in qs]
 
-        # Execute measurement
+        # Execute measurements
         conn.flush()
 
         # I guess this is always zero or one.
-        bit_flips[i] = int(m)
+        bit_flips[start:start + len(ms)] = np.fromiter(
+            (int(m) for m in ms), dtype=np.uint8, count=len(ms)
+        )
 
     # Return this implicit tuple thing.
     return bit_flips, basis_flips
 
 
-def filter_bases(socket, pairs_info):
-    # An array of tuples indexing pairs_info (established sequentially)
-    bases = [(i, pairs_info[i].basis) for (i, pair) in enumerate(pairs_info)]
-    
-    # Push over the channel
-    msg = StructuredMessage(header="Bases", payload=bases)
+def pack_bits(bits):
+    """Packs a sequence of zeros/ones 8 per byte, as base64 text since
+    structured messages are sent as JSON"""
+    return base64.b64encode(np.packbits(np.asarray(bits, dtype=np.uint8)).tobytes()).decode()
+
+
+def unpack_bits(payload, n):
+    """Inverse of pack_bits, for a sequence of n zeros/ones"""
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(payload), dtype=np.uint8))[:n]
+    assert len(bits) == n
+    return bits
+
+
+def filter_bases(socket, bases):
+    # Receive Bob's bases, which he only sends once he has measured all qubits,
+    # so ours are never published before his measurements are done
+    try:
+        remote_msg = socket.recv_structured()
+        if remote_msg.header != "Bases":
+            raise ValueError(f"unexpected header {remote_msg.header!r}")
+        remote_bases = unpack_bits(remote_msg.payload, len(bases))
+    except Exception as e:
+        raise RuntimeError("Failed to distribute BB84 states") from e
+
+    # Pairs are established sequentially, so no index is sent. Reply with
+    # only the comparison, packed 8 pairs per byte
+    same_basis = bases == remote_bases
+    msg = StructuredMessage(header="Same bases", payload=pack_bits(same_basis))
     socket.send_structured(msg)
 
-    # Receive remote bases
-    remote_bases = socket.recv_structured().payload
+    # Indices of pairs measured in the same basis
+    same_basis_indices = np.flatnonzero(same_basis).tolist()
 
-    # zip bases and remote bases, zipped into 
-    for (i, basis), (remote_i, remote_basis) in zip(bases, remote_bases):
-        assert i == remote_i
-        pairs_info[i].same_basis = basis == remote_basis
+    return same_basis.tolist(), same_basis_indices
 
-    return pairs_info
 
+def sample_indices(pool, k):
+    """Uniformly chooses k distinct elements of pool (Floyd's algorithm),
+    using O(k) memory instead of copying the pool."""
+    n = len(pool)
+    chosen = set()
+    for j in range(n - k, n):
+        t = random.randrange(j + 1)
+        chosen.add(j if t in chosen else t)
+    return [pool[i] for i in chosen]
 
-def estimate_error_rate(socket, pairs_info, num_test_bits):
-    # might shuffle the order around
-    same_basis_indices = [pair.index for pair in pairs_info if pair.same_basis]
 
+def estimate_error_rate(socket, pairs_info, same_basis_indices, num_test_bits):
     # Choose a quarter of the indices
-    test_indices = random.sample(
+    test_indices = sample_indices(
         same_basis_indices, min(num_test_bits, len(same_basis_indices))
     )
 
+    # Set for constant-time lookups; test_indices stays a list for the wire
+    test_set = set(test_indices)
+
     # For each pair -- generated
     for pair in pairs_info:
         # Set test_outcome to true or false if 
         # our "randomly-selected" indices, indicate we should do so.
-        pair.test_outcome = pair.index in test_indices
+        pair.test_outcome = pair.index in test_set
 
     # The outcomes from the test set
     test_outcomes = [(i, pairs_info[i].outcome) for i in test_indices]
@@ -153,7 +219,12 @@ def estimate_error_rate(socket, pairs_info, num_test_bits):
 
 
 def extract_key(x, r):
-    return sum([xj * rj for xj, rj in zip(x, r)]) % 2
+    # GF(2) inner product: parity of popcount(x & r), 8 bits per byte
+    n = min(len(x), len(r))
+    packed = np.packbits(np.asarray(x[:n], dtype=np.uint8)) & np.packbits(
+        np.asarray(r[:n], dtype=np.uint8)
+    )
+    return bin(int.from_bytes(packed.tobytes(), "big")).count("1") & 1
 
 
 def h(p):
@@ -163,7 +234,27 @@ def h(p):
         return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
 
 
-@dataclass
+def h_vec(p):
+    """Elementwise h over an array of probabilities, e.g. for QBER sweeps"""
+    p = np.asarray(p, dtype=np.float64)
+    q = 1 - p
+    # log2(1) == 0 keeps the p == 0 and p == 1 terms finite
+    out = -p * np.log2(np.where(p == 0, 1, p)) - q * np.log2(np.where(q == 0, 1, q))
+    # ... but leaves -0.0 there, h returns exactly 0
+    return np.where((p == 0) | (p == 1), 0.0, out)
+
+
+def h_table(n):
+    """h(k / n) for k = 0..n, computed once per n. Uses scalar h rather than
+    h_vec so entries match h bit for bit (np.log2 may round differently)."""
+    table = h_tables.get(n)
+    if table is None:
+        table = h_tables[n] = [h(k / n) for k in range(n + 1)]
+    return table
+
+
+# __slots__ via dataclass needs Python 3.10+, the apps still support 3.9
+@dataclass(**({"slots": True} if sys.version_info >= (3, 10) else {}))
 class PairInfo:
     """Information that Alice has about one generated pair.
     The information is filled progressively during the protocol."""
@@ -211,83 +302,86 @@ def main(app_config=None, num_bits=72, key_length=16):
             alice, epr_socket, socket, "bob", num_bits
         )
     
-    # Arrays of zeroes and ones
-    outcomes = [int(b) for b in bit_flips]
-    theta = [int(b) for b in basis_flips]
+    # Arrays of zeroes and ones, as plain ints for logging and results
+    outcomes = bit_flips.tolist()
+    theta = basis_flips.tolist()
 
     logger.info(f"alice outcomes: {outcomes}")
     logger.info(f"alice theta: {theta}")
 
-    # Boil down results to single array of dicts
-    pairs_info = []
-    for i in range(num_bits):
-        pairs_info.append(
-            PairInfo(
-                index=i,
-                basis=int(basis_flips[i]),
-                outcome=int(bit_flips[i]),
-            )
-        )
-    
     # Establish socket for filtering
-    m = socket.recv()
-    if m != ALL_MEASURED:
-        logger.info(m)
-        raise RuntimeError("Failed to distribute BB84 states")
+    if DEBUG_HANDSHAKE:
+        m = socket.recv()
+        if m != ALL_MEASURED:
+            logger.info(m)
+            raise RuntimeError("Failed to distribute BB84 states")
 
     # Classical channel used to exchange basis, and 
-    # storing "true" into same_basis for each matching exchange
-    pairs_info = filter_bases(socket, pairs_info)
+    # returning "true" in same_basis for each matching exchange
+    same_basis, same_basis_indices = filter_bases(socket, basis_flips)
 
+    # Boil down results to single array of dicts
+    pairs_info = [
+        PairInfo(index=i, basis=basis, outcome=outcome, same_basis=same)
+        for i, (basis, outcome, same) in enumerate(zip(theta, outcomes, same_basis))
+    ]
 
     logger.info(f"alice HAS DECIDED TO USE {num_test_bits} OF THOSE QUBITS")
     # Use the portion of the shared qubit measurements to perform
-    pairs_info, error_rate = estimate_error_rate(socket, pairs_info, num_test_bits)
+    pairs_info, error_rate = estimate_error_rate(
+        socket, pairs_info, same_basis_indices, num_test_bits
+    )
     logger.info(f"alice error rate: {error_rate}")
 
-    # Select the key from the untested qubit measurements sharing a basis
-    raw_key = [pair.outcome for pair in pairs_info if (not pair.test_outcome and pair.same_basis)]
-    logger.info(f"alice raw key: {raw_key}")
-    
     # Select the same basis using the raw key?
 
     # Return data.
 
-    # Establish a blank table
+    # Establish a blank key, table and counters, filled in a single pass
+    raw_key = []
     table = []
-    # For each pair
-    for pair in pairs_info:
-        # Transform basis into a name
-        basis = "X" if pair.basis == 1 else "Z"
-        # Identify pairs used in testing, and result
-        check = pair.same_outcome if pair.test_outcome else "-"
-        # Add to table
-        table.append([pair.index, basis, pair.same_basis, pair.outcome, check])
-    
     # Count selection rate
-    x_basis_count = sum(pair.basis for pair in pairs_info)
-    z_basis_count = num_bits - x_basis_count
-    
+    x_basis_count = 0
     # Number viable for testing or raw_key
-    same_basis_count = sum(pair.same_basis for pair in pairs_info)
-
+    same_basis_count = 0
     # Number of qubits used for error testing (i.e., same basis, and marked)
-    outcome_comparison_count = sum(
-        pair.test_outcome for pair in pairs_info if pair.same_basis
-    )
+    outcome_comparison_count = 0
+    # Number of tested qubits whose outcome matched Bob's
+    same_outcome_in_test = 0
+    # For each pair
+    for pair in pairs_info:
+        x_basis_count += pair.basis
+        same_basis_count += pair.same_basis
+        if pair.test_outcome:
+            # Identify pairs used in testing, and result
+            check = pair.same_outcome
+            outcome_comparison_count += pair.same_basis
+            same_outcome_in_test += pair.same_outcome
+        else:
+            check = "-"
+            # Select the key from the untested qubit measurements sharing a basis
+            if pair.same_basis:
+                raw_key.append(pair.outcome)
+        # Add to table, transforming basis into a name
+        table.append([pair.index, BASIS_NAMES[pair.basis], pair.same_basis, pair.outcome, check])
+
+    logger.info(f"alice raw key: {raw_key}")
+
+    z_basis_count = num_bits - x_basis_count
 
     # pairs which constitute errors
-    diff_outcome_count = outcome_comparison_count - sum(
-        pair.same_outcome for pair in pairs_info if pair.test_outcome
-    )
+    diff_outcome_count = outcome_comparison_count - same_outcome_in_test
     if outcome_comparison_count == 0:
         qber = 1
+        h_qber = h(qber)
     else:
         qber = (diff_outcome_count) / outcome_comparison_count
+        # Only outcome_comparison_count + 1 possible QBERs, so look h up
+        h_qber = h_table(outcome_comparison_count)[diff_outcome_count]
 
     # Compute a "key-rate potential"
     # Using the Binary entropy
-    key_rate_potential = 1 - 2 * h(qber)
+    key_rate_potential = 1 - 2 * h_qber
 
     return {
         # Table with one row per generated pair.
@@ -1,9 +1,14 @@
+import base64
 import json
 import math
-import random
+import os
+import secrets
+import sys
 from dataclasses import dataclass
 from typing import Optional
 
+import numpy as np
+
 from netqasm.logging.glob import get_netqasm_logger
 #from netqasm.sdk import EPRSocket
 
@@ -14,19 +19,38 @@ from netqasm.sdk.external import NetQASMConnection, Socket
 
 logger = get_netqasm_logger()
 
-buf_msgs = []  # type: ignore
+# Received bytes not yet returned as a message, may end in a partial frame
+buf_recv = bytearray()
 EOF = "EOF"
+# Table name of each basis, indexed by basis (0 = Z, 1 = X)
+BASIS_NAMES = ("Z", "X")
+# Tables from h_table, keyed by the number of compared outcomes
+h_tables = {}  # type: ignore
 ALL_MEASURED = "All qubits measured"
+# Only send ALL_MEASURED when debugging, our bases imply it. Must match Alice.
+DEBUG_HANDSHAKE = bool(os.environ.get("DEBUG_HANDSHAKE"))
+# Assured messages sent before blocking on an ACK from Alice, 1 is a strict fence
+ACK_WINDOW = 32
+# Sequence number of the next assured message, and highest seq Alice acknowledged
+send_seq = 0
+acked_seq = -1
+# Number of EPR pairs received per round-trip, must match Alice. Each pair
+# holds a live qubit until measured, so this is bounded by the 3 qubits per node
+# in the shipped networks (exp/input/network.yaml)
+BATCH_SIZE = 3
 
 
 def recv_single_msg(socket):
     """Used to not get multiple messages at a time"""
-    if len(buf_msgs) > 0:
-        msg = buf_msgs.pop(0)
-    else:
-        msgs = socket.recv().split(EOF)[:-1]
-        buf_msgs.extend(msgs[1:])
-        msg = msgs[0]
+    delim = EOF.encode()
+    idx = buf_recv.find(delim)
+    while idx < 0:
+        # Keep scanning only the newly received bytes (plus a possible split delimiter)
+        start = max(len(buf_recv) - len(delim) + 1, 0)
+        buf_recv.extend(socket.recv().encode())
+        idx = buf_recv.find(delim, start)
+    msg = buf_recv[:idx].decode()
+    del buf_recv[:idx + len(delim)]
     logger.debug(f"Bob received msg {msg}")
     return msg
 
@@ -36,53 +60,76 @@ def send_single_msg(socket, msg):
     socket.send(msg + EOF)
 
 
-def sendClassicalAssured(socket, data):
-    data = json.dumps(data)
+def sendClassicalAssured(socket, data, window=ACK_WINDOW):
+    global send_seq, acked_seq
+    # Only ask for an ACK once the window of unacknowledged messages is full
+    need_ack = send_seq - acked_seq >= window
+    data = json.dumps({"seq": send_seq, "ack": need_ack, "data": data})
     send_single_msg(socket, data)
-    while recv_single_msg(socket) != "ACK":
-        pass
+    send_seq += 1
+    while need_ack and acked_seq < send_seq - 1:
+        msg = recv_single_msg(socket)
+        if msg.startswith("ACK "):
+            acked_seq = int(msg[len("ACK "):])
 
 
 def recvClassicalAssured(socket):
-    data = recv_single_msg(socket)
-    data = json.loads(data)
-    send_single_msg(socket, "ACK")
-    return data
-
-
-def receive_bb92_states(conn, epr_socket, socket, target, n):
-    bit_flips = [None for _ in range(n)]
-    basis_flips = [random.randint(0, 1) for _ in range(n)]
-
-    for i in range(n):
-        q = epr_socket.recv_keep(1)[0]
-        print(f"received {q}")
-        if basis_flips[i]:
-            q.H()
-        m = q.measure()
+    msg = json.loads(recv_single_msg(socket))
+    # Messages arrive in order, so this acknowledges everything up to seq
+    if msg["ack"]:
+        send_single_msg(socket, f"ACK {msg['seq']}")
+    return msg["data"]
+
+
+def receive_bb92_states(conn, epr_socket, socket, target, n, batch_size=BATCH_SIZE):
+    bit_flips = np.empty(n, dtype=np.uint8)
+    basis_flips = np.unpackbits(
+        np.frombuffer(secrets.token_bytes((n + 7) // 8), dtype=np.uint8)
+    )[:n]
+
+    for start in range(0, n, batch_size):
+        qs = epr_socket.recv_keep(min(batch_size, n - start))
+        print(f"received {len(qs)} qubits")
+        for j, q in enumerate(qs):
+            if basis_flips[start + j]:
+                q.H()
+        ms = [q.measure() for q in qs]
         conn.flush()
-        bit_flips[i] = int(m)
+        bit_flips[start:start + len(ms)] = np.fromiter(
+            (int(m) for m in ms), dtype=np.uint8, count=len(ms)
+        )
 
     return bit_flips, basis_flips
 
 
-def filter_bases(socket, pairs_info):
-    bases = [(i, pairs_info[i].basis) for (i, pair) in enumerate(pairs_info)]
+def pack_bits(bits):
+    """Packs a sequence of zeros/ones 8 per byte, as base64 text since
+    structured messages are sent as JSON"""
+    return base64.b64encode(np.packbits(np.asarray(bits, dtype=np.uint8)).tobytes()).decode()
+
+
+def unpack_bits(payload, n):
+    """Inverse of pack_bits, for a sequence of n zeros/ones"""
+    bits = np.unpackbits(np.frombuffer(base64.b64decode(payload), dtype=np.uint8))[:n]
+    assert len(bits) == n
+    return bits
 
-    remote_bases = socket.recv_structured().payload
-    socket.send_structured(StructuredMessage("Bases", bases))
 
-    for (i, basis), (remote_i, remote_basis) in zip(bases, remote_bases):
-        assert i == remote_i
-        pairs_info[i].same_basis = basis == remote_basis
+def filter_bases(socket, bases):
+    # Only sent once all qubits are measured, which is what tells Alice we are done
+    socket.send_structured(StructuredMessage("Bases", pack_bits(bases)))
 
-    return pairs_info
+    # Alice replies with only the comparison, we never see her bases
+    same_basis = unpack_bits(socket.recv_structured().payload, len(bases)).astype(bool)
+
+    return same_basis.tolist()
 
 
 def estimate_error_rate(socket, pairs_info, num_test_bits):
     test_indices = socket.recv_structured().payload
+    test_set = set(test_indices)
     for pair in pairs_info:
-        pair.test_outcome = pair.index in test_indices
+        pair.test_outcome = pair.index in test_set
 
     test_outcomes = [(i, pairs_info[i].outcome) for i in test_indices]
 
@@ -106,10 +153,16 @@ def estimate_error_rate(socket, pairs_info, num_test_bits):
 
 
 def extract_key(x, r):
-    return sum([xj * rj for xj, rj in zip(x, r)]) % 2
+    # GF(2) inner product: parity of popcount(x & r), 8 bits per byte
+    n = min(len(x), len(r))
+    packed = np.packbits(np.asarray(x[:n], dtype=np.uint8)) & np.packbits(
+        np.asarray(r[:n], dtype=np.uint8)
+    )
+    return bin(int.from_bytes(packed.tobytes(), "big")).count("1") & 1
 
 
-@dataclass
+# __slots__ via dataclass needs Python 3.10+, the apps still support 3.9
+@dataclass(**({"slots": True} if sys.version_info >= (3, 10) else {}))
 class PairInfo:
     """Information that Bob has about one generated pair.
     The information is filled progressively during the protocol."""
@@ -140,6 +193,25 @@ def h(p):
         return -p * math.log2(p) - (1 - p) * math.log2(1 - p)
 
 
+def h_vec(p):
+    """Elementwise h over an array of probabilities, e.g. for QBER sweeps"""
+    p = np.asarray(p, dtype=np.float64)
+    q = 1 - p
+    # log2(1) == 0 keeps the p == 0 and p == 1 terms finite
+    out = -p * np.log2(np.where(p == 0, 1, p)) - q * np.log2(np.where(q == 0, 1, q))
+    # ... but leaves -0.0 there, h returns exactly 0
+    return np.where((p == 0) | (p == 1), 0.0, out)
+
+
+def h_table(n):
+    """h(k / n) for k = 0..n, computed once per n. Uses scalar h rather than
+    h_vec so entries match h bit for bit (np.log2 may round differently)."""
+    table = h_tables.get(n)
+    if table is None:
+        table = h_tables[n] = [h(k / n) for k in range(n + 1)]
+    return table
+
+
 def main(app_config=None, num_bits=72, key_length=16):
     num_test_bits = max(int(num_bits / 4), 1)
 
@@ -158,54 +230,57 @@ def main(app_config=None, num_bits=72, key_length=16):
             bob, epr_socket, socket, "alice", num_bits
         )
 
-    outcomes = [int(b) for b in bit_flips]
-    bases = [int(b) for b in basis_flips]
+    outcomes = bit_flips.tolist()
+    bases = basis_flips.tolist()
 
     logger.info(f"bob outcomes: {outcomes}")
     logger.info(f"bob bases: {bases}")
 
-    pairs_info = []
-    for i in range(num_bits):
-        pairs_info.append(
-            PairInfo(
-                index=i,
-                basis=int(basis_flips[i]),
-                outcome=int(bit_flips[i]),
-            )
-        )
+    if DEBUG_HANDSHAKE:
+        socket.send(ALL_MEASURED)
+    same_basis = filter_bases(socket, basis_flips)
 
-    socket.send(ALL_MEASURED)
-    pairs_info = filter_bases(socket, pairs_info)
+    pairs_info = [
+        PairInfo(index=i, basis=basis, outcome=outcome, same_basis=same)
+        for i, (basis, outcome, same) in enumerate(zip(bases, outcomes, same_basis))
+    ]
 
     pairs_info, error_rate = estimate_error_rate(socket, pairs_info, num_test_bits)
     logger.info(f"bob error_rate: {error_rate}")
 
-    raw_key = [pair.outcome for pair in pairs_info if (not pair.test_outcome and pair.same_basis)]
-
-    logger.info(f"bob raw key: {raw_key}")
-
     # Return data.
 
+    raw_key = []
     table = []
+    x_basis_count = 0
+    same_basis_count = 0
+    outcome_comparison_count = 0
+    same_outcome_in_test = 0
     for pair in pairs_info:
-        basis = "X" if pair.basis == 1 else "Z"
-        check = pair.same_outcome if pair.test_outcome else "-"
-        table.append([pair.index, basis, pair.same_basis, pair.outcome, check])
+        x_basis_count += pair.basis
+        same_basis_count += pair.same_basis
+        if pair.test_outcome:
+            check = pair.same_outcome
+            outcome_comparison_count += pair.same_basis
+            same_outcome_in_test += pair.same_outcome
+        else:
+            check = "-"
+            if pair.same_basis:
+                raw_key.append(pair.outcome)
+        table.append([pair.index, BASIS_NAMES[pair.basis], pair.same_basis, pair.outcome, check])
+
+    logger.info(f"bob raw key: {raw_key}")
 
-    x_basis_count = sum(pair.basis for pair in pairs_info)
     z_basis_count = num_bits - x_basis_count
-    same_basis_count = sum(pair.same_basis for pair in pairs_info)
-    outcome_comparison_count = sum(
-        pair.test_outcome for pair in pairs_info if pair.same_basis
-    )
-    diff_outcome_count = outcome_comparison_count - sum(
-        pair.same_outcome for pair in pairs_info if pair.test_outcome
-    )
+    diff_outcome_count = outcome_comparison_count - same_outcome_in_test
     if outcome_comparison_count == 0:
         qber = 1
+        h_qber = h(qber)
     else:
         qber = (diff_outcome_count) / outcome_comparison_count
-    key_rate_potential = 1 - 2 * h(qber)
+        # Only outcome_comparison_count + 1 possible QBERs, so look h up
+        h_qber = h_table(outcome_comparison_count)[diff_outcome_count]
+    key_rate_potential = 1 - 2 * h_qber
 
     return {
         # Table with one row per generated pair.